@@ -1,6 +1,13 @@
 import boto3
+from botocore.config import Config
 import sys
 
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=5,
+    read_timeout=30
+)
+
 def get_logs():
     log_group = '/aws/sagemaker/Endpoints/chandra-ocr-endpoint'
     
@@ -9,7 +16,7 @@ def get_logs():
     region = session.region_name or 'us-east-1'
     
     print(f"Fetching logs from {log_group} ({region})...")
-    client = boto3.client('logs', region_name=region)
+    client = boto3.client('logs', region_name=region, config=BOTO_CONFIG)
     
     try:
         # Get the most recent log stream
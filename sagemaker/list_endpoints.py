@@ -1,13 +1,27 @@
 
 import boto3
-import sagemaker
+from botocore.config import Config
+
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=5,
+    read_timeout=30
+)
+
+MAX_ENDPOINTS = 5
 
 try:
-    sm_client = boto3.client('sagemaker')
-    response = sm_client.list_endpoints(SortBy='CreationTime', SortOrder='Descending', MaxResults=5)
+    sm_client = boto3.client('sagemaker', config=BOTO_CONFIG)
+    # Paginator keeps following NextToken if MaxItems is raised past one page
+    paginator = sm_client.get_paginator('list_endpoints')
+    pages = paginator.paginate(
+        SortBy='CreationTime',
+        SortOrder='Descending',
+        PaginationConfig={'MaxItems': MAX_ENDPOINTS, 'PageSize': 100}
+    )
     
     print("Recent SageMaker Endpoints:")
-    for endpoint in response['Endpoints']:
+    for endpoint in (e for page in pages for e in page['Endpoints']):
         print(f"Name: {endpoint['EndpointName']}, Status: {endpoint['EndpointStatus']}, Created: {endpoint['CreationTime']}")
 except Exception as e:
     print(f"Error listing endpoints: {e}")
@@ -4,9 +4,16 @@ Build custom Docker image and push to ECR for SageMaker deployment
 This script is designed to run on Linux (Cloud9/EC2) where Docker creates Docker v2 manifests
 Only builds and pushes to ECR - deploy manually via AWS Console
 """
+import base64
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
 import subprocess
 import os
+import time
 
 # Configuration
 REGION = "us-east-1"
@@ -14,19 +21,104 @@ ACCOUNT_ID = "563224522620"
 IMAGE_NAME = "chandra-ocr-custom"
 IMAGE_TAG = "latest"
 
+# Adaptive retry backs off client-side before ECR/STS start throttling;
+# short connect timeout fails fast on a dead network instead of after 60s
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=5,
+    read_timeout=30
+)
+
+# One session for the whole script; each client is built once on first use
+SESSION = boto3.Session(region_name=REGION)
+
+@functools.lru_cache(maxsize=None)
+def get_sts_client():
+    return SESSION.client('sts', config=BOTO_CONFIG)
+
+@functools.lru_cache(maxsize=None)
+def get_ecr_client():
+    return SESSION.client('ecr', config=BOTO_CONFIG)
+
 # ECR repository URI
 ECR_REPOSITORY = f"{ACCOUNT_ID}.dkr.ecr.{REGION}.amazonaws.com/{IMAGE_NAME}"
 IMAGE_URI = f"{ECR_REPOSITORY}:{IMAGE_TAG}"
+# BuildKit layer cache (all stages) lives next to the image in the same repo
+BUILD_CACHE_REF = f"{ECR_REPOSITORY}:buildcache"
+BUILDER_NAME = "chandra-builder"
+
+# BuildKit's default GC budget is small enough to evict the ~4GB torch/CUDA
+# layers between builds; let the cache use up to half the disk instead. A
+# fraction of the disk (not a fixed size) so GC still runs before a small
+# Cloud9/EC2 volume fills up
+BUILDKITD_CONFIG = os.path.expanduser("~/.cache/chandra-buildkitd.toml")
+BUILDKITD_CONFIG_TOML = """[worker.oci]
+  gc = true
+  gckeepstorage = "50%"
+"""
+
+# Keep only the last few untagged (superseded) images in the repository
+UNTAGGED_LIFECYCLE_POLICY = {
+    "rules": [{
+        "rulePriority": 1,
+        "description": "Expire superseded untagged images",
+        "selection": {
+            "tagStatus": "untagged",
+            "countType": "imageCountMoreThan",
+            "countNumber": 3
+        },
+        "action": {"type": "expire"}
+    }]
+}
+
+# STS caller identity is cached on disk so repeat runs skip the round trip
+IDENTITY_CACHE = os.path.expanduser("~/.cache/chandra-deploy.json")
+IDENTITY_CACHE_TTL = 3600  # seconds
+
+@functools.lru_cache(maxsize=1)
+def get_caller_identity():
+    """Return the STS caller identity, cached for IDENTITY_CACHE_TTL seconds"""
+    key = f"{os.environ.get('AWS_PROFILE', 'default')}:{REGION}"
+    try:
+        with open(IDENTITY_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    
+    entry = cache.get(key)
+    if entry and time.time() - entry["cached_at"] < IDENTITY_CACHE_TTL:
+        return entry
+    
+    identity = get_sts_client().get_caller_identity()
+    entry = {
+        "Account": identity["Account"],
+        "Arn": identity["Arn"],
+        "cached_at": time.time()
+    }
+    cache[key] = entry
+    try:
+        os.makedirs(os.path.dirname(IDENTITY_CACHE), exist_ok=True)
+        with open(IDENTITY_CACHE, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass  # Cache is best-effort
+    return entry
 
 def check_prerequisites():
-    """Check if Docker and AWS CLI are available"""
+    """Check if Docker, buildx and AWS credentials are available"""
     print("="*70)
     print("CHECKING PREREQUISITES")
     print("="*70)
     
+    # The checks are independent I/O waits, so run them concurrently
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        docker_check = pool.submit(subprocess.run, ["docker", "--version"], capture_output=True, text=True)
+        buildx_check = pool.submit(subprocess.run, ["docker", "buildx", "version"], capture_output=True, text=True)
+        identity_check = pool.submit(get_caller_identity)
+    
     # Check Docker
     try:
-        result = subprocess.run(["docker", "--version"], capture_output=True, text=True)
+        result = docker_check.result()
         print(f"✅ Docker: {result.stdout.strip()}")
     except FileNotFoundError:
         print("❌ Docker not found. Please install Docker first.")
@@ -34,27 +126,84 @@ def check_prerequisites():
         print("   sudo service docker start")
         exit(1)
     
-    # Check AWS CLI
-    try:
-        result = subprocess.run(["aws", "--version"], capture_output=True, text=True)
-        print(f"✅ AWS CLI: {result.stderr.strip()}")  # aws --version outputs to stderr
-    except FileNotFoundError:
-        print("❌ AWS CLI not found. Please install AWS CLI first.")
+    # Check buildx (the registry layer cache needs it; docker.io/yum docker lack it)
+    result = buildx_check.result()
+    if result.returncode == 0:
+        print(f"✅ Docker buildx: {result.stdout.strip()}")
+    else:
+        print("❌ Docker buildx plugin not found. Please install it first.")
+        print("   Ubuntu/Debian: sudo apt-get install -y docker-buildx")
+        print("   Amazon Linux/RHEL:")
+        print("     mkdir -p ~/.docker/cli-plugins")
+        print("     curl -sSL https://github.com/docker/buildx/releases/download/v0.17.1/buildx-v0.17.1.linux-amd64 \\")
+        print("       -o ~/.docker/cli-plugins/docker-buildx")
+        print("     chmod +x ~/.docker/cli-plugins/docker-buildx")
         exit(1)
     
     # Check AWS credentials
     try:
-        sts = boto3.client('sts')
-        identity = sts.get_caller_identity()
+        identity = identity_check.result()
         print(f"✅ AWS Account: {identity['Account']}")
         print(f"✅ AWS User: {identity['Arn']}")
     except Exception as e:
         print(f"❌ AWS credentials not configured: {e}")
-        print("   Run: aws configure")
+        print("   Run: aws configure (or set AWS_* env vars / use an instance role)")
         exit(1)
     
     print()
 
+def create_repository(ecr_client):
+    """Create the ECR repository and lifecycle policy if missing.
+    
+    Returns (created, policy_error): created is False if the repository
+    already existed; policy_error is the ClientError if the policy couldn't
+    be checked or set, which is housekeeping and must not stop the deploy
+    """
+    try:
+        ecr_client.create_repository(repositoryName=IMAGE_NAME)
+        created = True
+    except ecr_client.exceptions.RepositoryAlreadyExistsException:
+        created = False
+    # Pushing over 'latest' (and ':buildcache') leaves the previous image
+    # untagged; let ECR expire those instead of deleting the tag before every
+    # push. Checked on every run so pre-existing repositories get it too
+    try:
+        try:
+            ecr_client.get_lifecycle_policy(repositoryName=IMAGE_NAME)
+        except ecr_client.exceptions.LifecyclePolicyNotFoundException:
+            ecr_client.put_lifecycle_policy(
+                repositoryName=IMAGE_NAME,
+                lifecyclePolicyText=json.dumps(UNTAGGED_LIFECYCLE_POLICY)
+            )
+    except ClientError as e:
+        return created, e
+    return created, None
+
+def pin_base_image(dockerfile):
+    """Pin an unpinned FROM tag in the Dockerfile to its current digest, once"""
+    with open(dockerfile) as f:
+        lines = f.readlines()
+    index = next(i for i, line in enumerate(lines) if line.startswith("FROM "))
+    base_image = lines[index].split()[1]
+    if "@sha256:" in base_image:
+        print(f"   ✓ Base image pinned: {base_image}")
+        return
+    
+    result = subprocess.run(
+        ["docker", "buildx", "imagetools", "inspect", base_image, "--format", "{{json .Manifest}}"],
+        capture_output=True,
+        text=True
+    )
+    try:
+        digest = json.loads(result.stdout)["digest"]
+    except (ValueError, KeyError):
+        print(f"   ⚠️  Could not resolve {base_image} digest, building from the tag")
+        return
+    lines[index] = lines[index].replace(base_image, f"{base_image}@{digest}", 1)
+    with open(dockerfile, "w") as f:
+        f.writelines(lines)
+    print(f"   ✓ Pinned {base_image} to {digest} in the Dockerfile - commit this change")
+
 def build_and_push_image():
     """
     Build Docker image and push to ECR
@@ -63,8 +212,8 @@ def build_and_push_image():
     print("STEP 1: BUILD AND PUSH DOCKER IMAGE")
     print("="*70)
     
-    # Change to the directory containing the Dockerfile
-    # Get the directory where this script is located
+    # Build context is the directory containing the Dockerfile,
+    # next to where this script is located
     script_dir = os.path.dirname(os.path.abspath(__file__))
     image_dir = os.path.join(script_dir, "sagemaker-custom-image")
     
@@ -73,98 +222,116 @@ def build_and_push_image():
         print(f"   Looking for: {image_dir}")
         exit(1)
     
-    os.chdir(image_dir)
-    
-    # Login to ECR
-    print("\n📋 Logging in to ECR...")
-    login_cmd = f"aws ecr get-login-password --region {REGION} | docker login --username AWS --password-stdin {ACCOUNT_ID}.dkr.ecr.{REGION}.amazonaws.com"
-    result = subprocess.run(login_cmd, shell=True)
-    if result.returncode != 0:
-        print("❌ ECR login failed")
-        exit(1)
-    print("   ✓ Login successful")
-    
-    # Create ECR repository if it doesn't exist
+    # Create ECR repository in the background while the login runs
     print(f"\n📋 Creating ECR repository: {IMAGE_NAME}")
-    ecr_client = boto3.client('ecr', region_name=REGION)
-    try:
-        ecr_client.create_repository(repositoryName=IMAGE_NAME)
-        print(f"   ✓ Repository created")
-    except ecr_client.exceptions.RepositoryAlreadyExistsException:
-        print(f"   ✓ Repository already exists")
+    ecr_client = get_ecr_client()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        repo_created = pool.submit(create_repository, ecr_client)
+        
+        # Login to ECR with a token from boto3 rather than spawning the AWS CLI
+        print("\n📋 Logging in to ECR...")
+        # The cached identity check can pass with credentials that have since
+        # expired, so this is where they fail
+        try:
+            auth = ecr_client.get_authorization_token()['authorizationData'][0]
+            username, password = base64.b64decode(auth['authorizationToken']).decode().split(':', 1)
+        except (ClientError, NoCredentialsError) as e:
+            print(f"❌ ECR login failed: {e}")
+            exit(1)
+        result = subprocess.run(
+            ["docker", "login", "--username", username, "--password-stdin", auth['proxyEndpoint']],
+            input=password,
+            text=True
+        )
+        if result.returncode != 0:
+            print("❌ ECR login failed")
+            exit(1)
+        print("   ✓ Login successful")
+        
+        created, policy_error = repo_created.result()
+        if created:
+            print(f"   ✓ Repository created")
+        else:
+            print(f"   ✓ Repository already exists")
+        if policy_error is not None:
+            print(f"   ⚠️  Could not set the untagged-image lifecycle policy: {policy_error}")
+            print(f"   Superseded images will accumulate in {IMAGE_NAME} until one is set")
     
-    # Delete existing image with 'latest' tag if it exists
-    print(f"\n🗑️  Deleting old image from ECR (if exists)...")
+    # Registry cache export needs a docker-container buildx builder
+    print(f"\n🔧 Preparing buildx builder: {BUILDER_NAME}")
+    result = subprocess.run(
+        ["docker", "buildx", "inspect", BUILDER_NAME],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    builder_exists = result.returncode == 0
+    # buildkitd only reads its config when the builder is created; the file
+    # written at creation records which config the existing builder runs with
     try:
-        ecr_client.batch_delete_image(
-            repositoryName=IMAGE_NAME,
-            imageIds=[{'imageTag': IMAGE_TAG}]
+        with open(BUILDKITD_CONFIG) as f:
+            config_current = f.read() == BUILDKITD_CONFIG_TOML
+    except OSError:
+        config_current = False
+    if builder_exists and not config_current:
+        print("   Recreating builder to apply the current GC settings...")
+        subprocess.run(["docker", "buildx", "rm", BUILDER_NAME])
+    if not (builder_exists and config_current):
+        os.makedirs(os.path.dirname(BUILDKITD_CONFIG), exist_ok=True)
+        with open(BUILDKITD_CONFIG, "w") as f:
+            f.write(BUILDKITD_CONFIG_TOML)
+        result = subprocess.run(
+            ["docker", "buildx", "create", "--name", BUILDER_NAME, "--driver", "docker-container",
+             "--config", BUILDKITD_CONFIG]
         )
-        print(f"   ✓ Old image deleted")
-    except:
-        print(f"   ✓ No old image to delete")
-    
-    # Build Docker image
-    print(f"\n🐳 Building Docker image...")
-    print(f"   This will take 5-7 minutes (downloading ~4GB of dependencies)...")
-    build_cmd = f"docker build --platform linux/amd64 -t {IMAGE_NAME}:{IMAGE_TAG} ."
-    
-    # Remove existing local image if present
-    subprocess.run(f"docker rmi {IMAGE_NAME}:{IMAGE_TAG} 2>/dev/null", shell=True)
-    
-    result = subprocess.run(build_cmd, shell=True)
     if result.returncode != 0:
-        print("❌ Docker build failed")
+        print("❌ Could not create buildx builder")
         exit(1)
-    print(f"   ✓ Image built: {IMAGE_NAME}:{IMAGE_TAG}")
-    
-    # Verify manifest type (Linux should create Docker v2)
-    print(f"\n🔍 Verifying image manifest type...")
-    inspect_cmd = f"docker inspect {IMAGE_NAME}:{IMAGE_TAG}"
-    result = subprocess.run(inspect_cmd, shell=True, capture_output=True, text=True)
-    if "oci" in result.stdout.lower():
-        print(f"   ⚠️  Warning: Image may have OCI manifest")
-    else:
-        print(f"   ✓ Image appears to have Docker v2 manifest")
-    
-    # Tag image
-    print(f"\n🏷️  Tagging image for ECR...")
-    tag_cmd = f"docker tag {IMAGE_NAME}:{IMAGE_TAG} {IMAGE_URI}"
-    subprocess.run(tag_cmd, shell=True, check=True)
-    print(f"   ✓ Tagged as: {IMAGE_URI}")
-    
-    # Push to ECR
-    print(f"\n⬆️  Pushing to ECR...")
-    print(f"   This will take 3-5 minutes (pushing ~4GB compressed)...")
-    push_cmd = f"docker push {IMAGE_URI}"
-    result = subprocess.run(push_cmd, shell=True)
+    print(f"   ✓ Builder ready")
+    
+    pin_base_image(os.path.join(image_dir, "Dockerfile"))
+    
+    # Build and push in one step; unchanged layers come from the registry cache
+    # Docker v2 media types and no provenance attestation keep the manifest
+    # a plain Docker v2 image that SageMaker accepts. The cache keeps the
+    # default gzip compression so cache hits are pushed as the same blobs
+    print(f"\n🐳 Building and pushing Docker image...")
+    print(f"   First build takes 8-12 minutes (downloading ~4GB of dependencies)...")
+    print(f"   Unchanged layers are reused from {BUILD_CACHE_REF}")
+    build_cmd = [
+        "docker", "buildx", "build",
+        "--builder", BUILDER_NAME,
+        "--platform", "linux/amd64",
+        "--provenance=false",
+        "--cache-from", f"type=registry,ref={BUILD_CACHE_REF}",
+        "--cache-to", f"type=registry,ref={BUILD_CACHE_REF},mode=max,"
+                      "image-manifest=true,oci-mediatypes=true",
+        "--output", f"type=image,name={IMAGE_URI},push=true,oci-mediatypes=false",
+        "."
+    ]
+    result = subprocess.run(build_cmd, cwd=image_dir)
     if result.returncode != 0:
-        print("❌ Docker push failed")
+        print("❌ Docker build/push failed")
         exit(1)
-    print(f"   ✓ Pushed to ECR")
+    print(f"   ✓ Built and pushed: {IMAGE_URI}")
     
     # Verify pushed image manifest
     print(f"\n🔍 Verifying ECR manifest type...")
     try:
-        response = ecr_client.batch_get_image(
+        # describe_images reports the media type without downloading the manifest
+        response = ecr_client.describe_images(
             repositoryName=IMAGE_NAME,
-            imageIds=[{'imageTag': IMAGE_TAG}],
-            acceptedMediaTypes=['application/vnd.docker.distribution.manifest.v2+json',
-                              'application/vnd.oci.image.manifest.v1+json']
+            imageIds=[{'imageTag': IMAGE_TAG}]
         )
-        if response['images']:
-            manifest_media_type = response['images'][0].get('imageManifest', '')
-            if 'oci' in manifest_media_type:
-                print(f"   ❌ ECR image has OCI manifest: {manifest_media_type}")
+        if response['imageDetails']:
+            manifest_media_type = response['imageDetails'][0].get('imageManifestMediaType', '')
+            if manifest_media_type != 'application/vnd.docker.distribution.manifest.v2+json':
+                print(f"   ❌ ECR image is not a Docker v2 manifest: {manifest_media_type}")
                 print(f"   This may cause SageMaker deployment to fail")
             else:
                 print(f"   ✅ ECR image has Docker v2 manifest")
     except Exception as e:
         print(f"   ⚠️  Could not verify manifest: {e}")
     
-    # Change back to original directory
-    os.chdir("..")
-    
     print("\n✅ Docker image ready!")
     return IMAGE_URI
 
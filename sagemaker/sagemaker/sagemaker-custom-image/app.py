@@ -61,4 +61,5 @@ def invocations():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    # Threaded so concurrent requests can be micro-batched by predict_fn
+    app.run(host='0.0.0.0', port=8080, threaded=True)
@@ -19,13 +19,16 @@ echo "======================================================================="
 
 # Set PYTHONPATH
 export PYTHONPATH=/opt/ml/code:$PYTHONPATH
+# Tokenizer thread pools don't mix with gunicorn's request threads
+export TOKENIZERS_PARALLELISM=false
 
 # Start gunicorn (ignore any arguments like 'serve' that SageMaker passes)
 echo "Starting gunicorn server on 0.0.0.0:8080..."
 exec gunicorn \
     --bind=0.0.0.0:8080 \
     --workers=1 \
-    --worker-class=sync \
+    --worker-class=gthread \
+    --threads=${GUNICORN_THREADS:-8} \
     --timeout=3600 \
     --graceful-timeout=3600 \
     --keep-alive=60 \
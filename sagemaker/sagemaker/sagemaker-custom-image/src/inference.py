@@ -1,19 +1,114 @@
 """
 Inference code for Chandra OCR model on SageMaker
 """
-import json
 import base64
 import io
+import os
+import queue
+import threading
 import time
+import orjson
 from PIL import Image
 import torch
-from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen3VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 from chandra.model.hf import generate_hf
 from chandra.model.schema import BatchInputItem
 from chandra.output import parse_markdown
+from chandra.prompts import PROMPT_MAPPING
+from chandra.settings import settings
 
 _model = None
 
+# Longest image side passed to the model; larger inputs are downscaled
+MAX_DIMENSION = 2048
+
+# Micro-batching: concurrent requests arriving within BATCH_TIMEOUT_MS of each
+# other share one generate_hf call, amortizing weight reads across the batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+BATCH_TIMEOUT = int(os.environ.get("BATCH_TIMEOUT_MS", "20")) / 1000
+
+_batch_queue = queue.Queue()
+
+
+class _PendingRequest:
+    """One queued predict_fn call, completed by the batch worker"""
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _generate(batch, model):
+    """Run generate_hf, clearing the CUDA cache and retrying once on OOM"""
+    out_of_memory = False
+    with torch.inference_mode():
+        try:
+            return generate_hf(batch, model, max_output_tokens=4096)
+        except torch.cuda.OutOfMemoryError:
+            out_of_memory = True
+        
+        # Recover outside the except block: until it exits, the traceback keeps
+        # the failed generate frames (and their tensors) alive, so empty_cache()
+        # could not release them and the retry would run on top of them
+        if out_of_memory:
+            # Only give cached blocks back to the driver when we actually ran out
+            print(f"CUDA OOM on batch of {len(batch)} - clearing cache and retrying")
+            torch.cuda.empty_cache()
+            return generate_hf(batch, model, max_output_tokens=4096)
+
+
+def _batch_worker(model):
+    """Drain the queue into batches of up to MAX_BATCH_SIZE and run them.
+    
+    Only generation happens here; post-processing stays in predict_fn so the
+    GPU never waits on CPU-side parsing.
+    """
+    while True:
+        pending = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        while len(pending) < MAX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        try:
+            _run_batch(pending, model)
+        finally:
+            for p in pending:
+                p.done.set()
+
+
+def _run_batch(pending, model):
+    """Generate for a batch, giving each request its own result or error"""
+    batch_failed = False
+    try:
+        results = _generate([p.item for p in pending], model)
+    except Exception as e:
+        if len(pending) == 1:
+            pending[0].error = e
+            return
+        batch_failed = True
+    
+    if batch_failed:
+        # One bad item must not fail the requests batched with it; rerun each
+        # on its own, outside the except block so the failed batch is released
+        print(f"Batch of {len(pending)} failed - retrying one at a time")
+        for p in pending:
+            try:
+                p.result = _generate([p.item], model)[0]
+            except Exception as e:
+                p.error = e
+        return
+    
+    for p, result in zip(pending, results):
+        p.result = result
+
 def model_fn(model_dir):
     """Load the Chandra OCR model - called once when container starts"""
     global _model
@@ -23,21 +118,96 @@ def model_fn(model_dir):
     print("=" * 70)
     
     model_id = "datalab-to/chandra"
+    # Prefer weights SageMaker already staged locally over a Hub download
+    if os.path.isfile(os.path.join(model_dir, "config.json")):
+        model_id = model_dir
+    print(f"Loading weights from: {model_id}")
     
     if not torch.cuda.is_available():
         raise RuntimeError("GPU REQUIRED! Use ml.g4dn or ml.g5 instance.")
     
     print(f"GPU detected: {torch.cuda.get_device_name(0)}")
     
+    # TF32 tensor cores for any fp32 side-paths (no-op before Ampere)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+    
+    # TORCH_ATTN is chandra's own setting; unset picks the fastest fused kernel.
+    # FA2 needs the flash-attn package and an Ampere+ GPU (not g4dn's T4),
+    # SDPA works on both T4 and A10G
+    fa2_supported = is_flash_attn_2_available() and torch.cuda.get_device_capability(0)[0] >= 8
+    attn_implementation = settings.TORCH_ATTN
+    if not attn_implementation:
+        attn_implementation = "flash_attention_2" if fa2_supported else "sdpa"
+    elif attn_implementation == "flash_attention_2" and not fa2_supported:
+        print("⚠️  flash_attention_2 unavailable on this instance, falling back to sdpa")
+        attn_implementation = "sdpa"
+    load_kwargs = {"attn_implementation": attn_implementation}
+    print(f"Attention: {attn_implementation}")
+    quantization = os.environ.get("MODEL_QUANTIZATION", "").lower()
+    # Vision encoder is small and quality-sensitive: keep it (and lm_head) in
+    # bf16 either way; bitsandbytes honours llm_int8_skip_modules for 4-bit too
+    skip_modules = ["visual", "lm_head"]
+    if quantization == "4bit":
+        # Weight-only 4-bit: decoding is bound by weight reads, not FLOPs.
+        # NF4 fits normally distributed weights better than plain FP4, and
+        # double quantization also compresses the per-block scales
+        load_kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            llm_int8_skip_modules=skip_modules
+        )
+    elif quantization == "8bit":
+        load_kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_skip_modules=skip_modules
+        )
+    elif quantization:
+        raise ValueError(f"Unsupported MODEL_QUANTIZATION: {quantization}")
+    if quantization:
+        print(f"Quantization: {quantization}")
+    
     _model = Qwen3VLForConditionalGeneration.from_pretrained(
         model_id,
         trust_remote_code=True,
         dtype=torch.bfloat16,
         device_map="auto",
-        low_cpu_mem_usage=True
+        low_cpu_mem_usage=True,
+        **load_kwargs
     ).eval()
+    print(f"GPU memory allocated: {torch.cuda.memory_allocated() / 1e9:.2f} GB")
+    # Keep the KV cache across decode steps (no gradient checkpointing at inference)
+    _model.generation_config.use_cache = True
+    
+    if os.environ.get("TORCH_COMPILE", "").lower() in ("1", "true"):
+        # With a static KV cache, generate() torch.compiles the fixed-shape
+        # decode step itself (generation_config.compile_config) and leaves
+        # prefill eager, whose length varies with image and batch size - so no
+        # manual torch.compile here. Set via generation_config because
+        # generate_hf does not forward generate kwargs
+        print("Static KV cache enabled - generate will compile the decode step")
+        _model.generation_config.cache_implementation = "static"
     
-    _model.processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+    # Fast (torchvision-backed) image processor fuses rescale/normalize on tensors
+    _model.processor = AutoProcessor.from_pretrained(
+        model_id,
+        trust_remote_code=True,
+        use_fast=True
+    )
+    # Batched decoder-only generation needs left padding
+    _model.processor.tokenizer.padding_side = "left"
+    
+    # One tiny generation warms CUDA kernels and the caching allocator pool,
+    # so the first real request doesn't pay for it
+    print("Warming up model...")
+    warmup_batch = [BatchInputItem(image=Image.new("RGB", (256, 256), "white"), prompt_type="ocr_layout")]
+    with torch.inference_mode():
+        generate_hf(warmup_batch, _model, max_output_tokens=8)
+    
+    threading.Thread(target=_batch_worker, args=(_model,), daemon=True).start()
+    print(f"Batching up to {MAX_BATCH_SIZE} requests per {BATCH_TIMEOUT * 1000:.0f}ms window")
     
     print("Model loaded successfully!")
     return _model
@@ -48,17 +218,30 @@ def input_fn(request_body, content_type):
     if content_type != "application/json":
         raise ValueError(f"Unsupported content type: {content_type}")
     
-    data = json.loads(request_body)
+    # orjson parses the multi-MB base64 payload far faster than stdlib json
+    data = orjson.loads(request_body)
     
     if "image" not in data:
         raise ValueError("Missing 'image' field in request body")
     
+    prompt_type = data.get("prompt_type", "ocr_layout")
+    if prompt_type not in PROMPT_MAPPING:
+        raise ValueError(f"Unsupported prompt_type: {prompt_type}")
+    
     image_bytes = base64.b64decode(data["image"])
     image = Image.open(io.BytesIO(image_bytes))
     
+    # Shrink-on-load: libjpeg decodes at 1/2, 1/4 or 1/8 scale (no-op for non-JPEG)
+    if max(image.size) > MAX_DIMENSION:
+        ratio = MAX_DIMENSION / max(image.size)
+        image.draft("RGB", tuple(int(dim * ratio) for dim in image.size))
+    # Image.open is lazy; decode here so a corrupt image fails this request
+    # instead of the batch it would otherwise be decoded in
+    image.load()
+    
     return {
         "image": image,
-        "prompt_type": data.get("prompt_type", "ocr_layout")
+        "prompt_type": prompt_type
     }
 
 
@@ -69,23 +252,32 @@ def predict_fn(data, model):
     prompt_type = data["prompt_type"]
     
     # Resize large images to prevent OOM
-    MAX_DIMENSION = 2048
+    if max(image.size) > MAX_DIMENSION:
+        # reduce() only supports non-palette modes
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGB")
+        # Cheap box filter for the integer part of the ratio, BILINEAR for the
+        # remaining <2x step (chandra resamples again in scale_to_fit)
+        factor = max(image.size) // MAX_DIMENSION
+        if factor >= 2:
+            image = image.reduce(factor)
     if max(image.size) > MAX_DIMENSION:
         ratio = MAX_DIMENSION / max(image.size)
         new_size = tuple(int(dim * ratio) for dim in image.size)
-        image = image.resize(new_size, Image.Resampling.LANCZOS)
+        image = image.resize(new_size, Image.Resampling.BILINEAR)
     
-    torch.cuda.empty_cache()
-    
-    batch = [BatchInputItem(image=image, prompt_type=prompt_type)]
-    
-    with torch.no_grad():
-        result = generate_hf(batch, model, max_output_tokens=4096)[0]
+    # Hand off to the batch worker started in model_fn and wait for our result
+    pending = _PendingRequest(BatchInputItem(image=image, prompt_type=prompt_type))
+    _batch_queue.put(pending)
+    pending.done.wait()
+    if pending.error is not None:
+        raise pending.error
+    result = pending.result
     
+    # Parse on the request thread: the batch worker only runs generation, so
+    # it is already decoding the next batch while this regex-heavy step runs
     markdown = parse_markdown(result.raw)
     
-    torch.cuda.empty_cache()
-    
     duration = time.time() - start_time
     print(f"Inference completed in {duration:.2f}s")
     
@@ -98,4 +290,5 @@ def predict_fn(data, model):
 
 def output_fn(prediction, accept):
     """Format output as JSON"""
-    return json.dumps(prediction), accept
+    # Bytes go straight into the Flask response body, no re-encoding
+    return orjson.dumps(prediction), accept